@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import argparse
+import logging
 import os
 import sys
 
@@ -11,10 +12,15 @@ from src.database import EmailDatabase
 def main():
     parser = argparse.ArgumentParser(description="Check for replies to cold emails")
     parser.add_argument("--stats", action="store_true", help="Show database statistics")
-    parser.add_argument("--mark-processed", type=int, help="Mark reply ID as processed")
+    parser.add_argument("--mark-processed", type=int, nargs="+", metavar="REPLY_ID", help="Mark reply ID(s) as processed")
     parser.add_argument("--show-all", action="store_true", help="Show all replies (including processed)")
+    parser.add_argument("--full-threads", action="store_true", help="Fetch full threads in one request (fewer round trips, more bandwidth)")
+    parser.add_argument("--full-scan", action="store_true", help="Scan every tracked thread instead of only threads changed since the last check")
     args = parser.parse_args()
 
+    # Progress from src.reply_checker is logged at INFO
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     db = EmailDatabase()
 
     if args.stats:
@@ -27,8 +33,8 @@ def main():
         return
 
     if args.mark_processed:
-        db.mark_reply_processed(args.mark_processed)
-        print(f"✅ Marked reply {args.mark_processed} as processed")
+        db.mark_replies_processed(args.mark_processed)
+        print(f"✅ Marked reply {', '.join(map(str, args.mark_processed))} as processed")
         return
 
     if args.show_all:
@@ -38,7 +44,10 @@ def main():
     print("🔍 Checking for new replies to your cold emails...")
     
     try:
-        new_replies = check_for_new_replies()
+        new_replies = check_for_new_replies(
+            thread_format="full" if args.full_threads else "metadata",
+            full_scan=args.full_scan,
+        )
         
         if not new_replies:
             print("✅ No new replies found")
@@ -57,7 +66,7 @@ def main():
             print(f"   Reply ID: {company_info['reply_id']}")
             print()
         
-        print("💡 Tip: Use --mark-processed <reply_id> to mark replies as handled")
+        print("💡 Tip: Use --mark-processed <reply_id> [<reply_id> ...] to mark replies as handled")
         print("💡 Tip: Use --stats to see campaign statistics")
         
     except Exception as e:
@@ -3,20 +3,22 @@ from __future__ import annotations
 from dataclasses import dataclass
 from typing import Optional
 import os
-import importlib
 
-def _load_toml(path: str) -> dict:
-    # Prefer stdlib tomllib if available, else fall back to tomli
-    mod = None
+# Prefer stdlib tomllib if available, else fall back to tomli
+try:
+    import tomllib as _toml
+except ImportError:  # pragma: no cover - Python < 3.11
     try:
-        mod = importlib.import_module("tomllib")
-    except Exception:
-        try:
-            mod = importlib.import_module("tomli")
-        except Exception as e:
-            raise RuntimeError("Neither tomllib (3.11+) nor tomli is available. Install tomli.") from e
+        import tomli as _toml  # type: ignore
+    except ImportError:
+        _toml = None  # type: ignore
+
+
+def _load_toml(path: str) -> dict:
+    if _toml is None:
+        raise RuntimeError("Neither tomllib (3.11+) nor tomli is available. Install tomli.")
     with open(path, "rb") as f:
-        return mod.load(f)
+        return _toml.load(f)
 
 
 @dataclass
@@ -2,12 +2,85 @@ from __future__ import annotations
 
 import sqlite3
 import os
-from typing import List, Optional, Dict, Any
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Dict, Any
 from dataclasses import dataclass
 from datetime import datetime
 import json
 
 
+def _adapt_datetime(value: datetime) -> str:
+    return value.isoformat(" ")
+
+
+def _convert_timestamp(value: bytes) -> datetime:
+    return datetime.fromisoformat(value.decode())
+
+
+# Explicit adapter/converter for TIMESTAMP columns (the stdlib defaults are
+# deprecated since Python 3.12). The converter runs inside the cursor, so rows
+# come back with datetime values already in place.
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+
+# Rows fetched per round trip by the iter_* generators
+ITER_BATCH_SIZE = 256
+
+# SQL is kept in module-level constants so every call passes the exact same
+# text and hits the connection's prepared-statement cache.
+SQL_INSERT_SENT = """
+    INSERT INTO sent_emails
+    (thread_id, message_id, prospect_email, prospect_name, company, subject, body, sent_at, label)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_INSERT_REPLY = """
+    INSERT OR IGNORE INTO replies
+    (sent_email_id, message_id, from_email, reply_content, received_at, processed)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+# INSERT ... RETURNING needs SQLite 3.35+; older libraries fall back to lastrowid
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+SQL_INSERT_SENT_RETURNING = SQL_INSERT_SENT + "    RETURNING id\n"
+SQL_INSERT_REPLY_RETURNING = """
+    INSERT INTO replies
+    (sent_email_id, message_id, from_email, reply_content, received_at, processed)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(message_id) DO NOTHING
+    RETURNING id
+"""
+# LIMIT -1 means "no limit" in SQLite
+SQL_GET_SENT = "SELECT * FROM sent_emails ORDER BY sent_at DESC LIMIT ?"
+SQL_GET_BY_THREAD = "SELECT * FROM sent_emails WHERE thread_id = ? LIMIT 1"
+SQL_REPLY_ID_BY_MESSAGE = "SELECT id FROM replies WHERE message_id = ?"
+SQL_REPLY_IDS_BY_MESSAGE = "SELECT message_id, id FROM replies WHERE message_id IN ({placeholders})"
+SQL_REPLY_EXISTS = "SELECT 1 FROM replies WHERE message_id = ? LIMIT 1"
+SQL_NEW_REPLIES = "SELECT * FROM replies WHERE processed = 0 ORDER BY received_at DESC"
+SQL_MARK_PROCESSED = "UPDATE replies SET processed = TRUE WHERE id = ?"
+SQL_MARK_PROCESSED_MANY = "UPDATE replies SET processed = TRUE WHERE id IN ({placeholders})"
+# Stay below SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds (999)
+SQL_MAX_PARAMS = 999
+SQL_STATS = """
+    SELECT
+        (SELECT COUNT(*) FROM sent_emails) AS sent,
+        COUNT(*) AS total,
+        SUM(CASE WHEN processed = 0 THEN 1 ELSE 0 END) AS new_replies
+    FROM replies
+"""
+SQL_THREAD_IDS = "SELECT DISTINCT thread_id FROM sent_emails"
+SQL_GET_META = "SELECT value FROM meta WHERE key = ?"
+SQL_SET_META = """
+    INSERT INTO meta (key, value) VALUES (?, ?)
+    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+"""
+# meta key of the Gmail historyId the last reply check caught up to
+META_LAST_HISTORY_ID = "last_history_id"
+# meta key of the threads (JSON list) the last reply check failed to read
+META_RETRY_THREAD_IDS = "retry_thread_ids"
+# meta key of untracked threads seen in the Gmail history (JSON thread ID -> first seen, epoch s)
+META_UNTRACKED_THREADS = "untracked_threads"
+
+
 @dataclass
 class SentEmail:
     id: Optional[int]
@@ -38,11 +111,37 @@ class EmailDatabase:
         self.db_path = db_path
         # Ensure data directory exists
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # One shared connection for the lifetime of this object; the lock
+        # serializes access because sqlite3 connections are not thread-safe.
+        self._conn = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-20000")
+        self._lock = threading.Lock()
         self._init_database()
 
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
+
     def _init_database(self):
         """Initialize SQLite database with required tables."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._conn
+            # WAL persists in the database file; synchronous=NORMAL is safe with
+            # WAL and avoids an fsync on every commit.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute("PRAGMA foreign_keys=ON")
+
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS sent_emails (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -71,108 +170,179 @@ class EmailDatabase:
                 )
             """)
             
+            # Small key/value store for sync state (e.g. the last Gmail historyId)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            
             # Create indexes for better performance
             conn.execute("CREATE INDEX IF NOT EXISTS idx_thread_id ON sent_emails(thread_id)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_prospect_email ON sent_emails(prospect_email)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_message_id ON sent_emails(message_id)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_reply_message_id ON replies(message_id)")
+            # Lets get_new_replies seek unprocessed rows already in received_at order
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_replies_processed_recv ON replies(processed, received_at DESC)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_replies_sent_email_id ON replies(sent_email_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_at ON sent_emails(sent_at DESC)")
             
+    @staticmethod
+    def _sent_email_row(email: SentEmail) -> tuple:
+        return (
+            email.thread_id,
+            email.message_id,
+            email.prospect_email,
+            email.prospect_name,
+            email.company,
+            email.subject,
+            email.body,
+            email.sent_at,
+            email.label
+        )
+
+    @staticmethod
+    def _reply_row(reply: EmailReply) -> tuple:
+        return (
+            reply.sent_email_id,
+            reply.message_id,
+            reply.from_email,
+            reply.reply_content,
+            reply.received_at,
+            reply.processed
+        )
+
+    @contextmanager
+    def _write_transaction(self):
+        """Group statements into one explicit write transaction (one commit).
+
+        Caller must hold self._lock.
+        """
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _executemany_in_transaction(self, sql: str, rows: List[tuple]):
+        """Run executemany inside one explicit write transaction. Caller must hold self._lock."""
+        with self._write_transaction() as conn:
+            conn.executemany(sql, rows)
+
+    def _insert_one(self, sql: str, sql_returning: str, params: tuple) -> int:
+        """Insert a single row and return its ID (0 if the insert was ignored).
+
+        Caller must hold self._lock.
+        """
+        if SQLITE_HAS_RETURNING:
+            row = self._conn.execute(sql_returning, params).fetchone()
+            return row[0] if row else 0
+        return self._conn.execute(sql, params).lastrowid
+
     def save_sent_email(self, email: SentEmail) -> int:
         """Save sent email to database, return the inserted ID."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                INSERT INTO sent_emails 
-                (thread_id, message_id, prospect_email, prospect_name, company, subject, body, sent_at, label)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                email.thread_id,
-                email.message_id,
-                email.prospect_email,
-                email.prospect_name,
-                email.company,
-                email.subject,
-                email.body,
-                email.sent_at,
-                email.label
-            ))
-            return cursor.lastrowid
+        with self._lock:
+            return self._insert_one(SQL_INSERT_SENT, SQL_INSERT_SENT_RETURNING, self._sent_email_row(email))
+
+    def save_sent_emails_bulk(self, emails: List[SentEmail]):
+        """Save many sent emails in a single transaction."""
+        if not emails:
+            return
+        with self._lock:
+            self._executemany_in_transaction(SQL_INSERT_SENT, [self._sent_email_row(e) for e in emails])
+
+    @staticmethod
+    def _row_to_sent_email(row: sqlite3.Row) -> SentEmail:
+        return SentEmail(
+            id=row["id"],
+            thread_id=row["thread_id"],
+            message_id=row["message_id"],
+            prospect_email=row["prospect_email"],
+            prospect_name=row["prospect_name"],
+            company=row["company"],
+            subject=row["subject"],
+            body=row["body"],
+            sent_at=row["sent_at"],
+            label=row["label"]
+        )
+
+    def iter_sent_emails(self, limit: Optional[int] = None) -> Iterator[SentEmail]:
+        """Yield sent emails (newest first) without loading them all into memory."""
+        with self._lock:
+            cursor = self._conn.execute(SQL_GET_SENT, (limit if limit else -1,))
+        while True:
+            # Re-take the lock per batch so callers may use the database between rows
+            with self._lock:
+                rows = cursor.fetchmany(ITER_BATCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield self._row_to_sent_email(row)
 
     def get_sent_emails(self, limit: Optional[int] = None) -> List[SentEmail]:
         """Get all sent emails, optionally limited."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            query = "SELECT * FROM sent_emails ORDER BY sent_at DESC"
-            if limit:
-                query += f" LIMIT {limit}"
-                
-            rows = conn.execute(query).fetchall()
-            return [
-                SentEmail(
-                    id=row["id"],
-                    thread_id=row["thread_id"],
-                    message_id=row["message_id"],
-                    prospect_email=row["prospect_email"],
-                    prospect_name=row["prospect_name"],
-                    company=row["company"],
-                    subject=row["subject"],
-                    body=row["body"],
-                    sent_at=datetime.fromisoformat(row["sent_at"]),
-                    label=row["label"]
-                ) for row in rows
-            ]
+        return list(self.iter_sent_emails(limit))
 
     def get_sent_email_by_thread_id(self, thread_id: str) -> Optional[SentEmail]:
         """Get sent email by thread ID."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            row = conn.execute(
-                "SELECT * FROM sent_emails WHERE thread_id = ? LIMIT 1",
-                (thread_id,)
-            ).fetchone()
-            
-            if row:
-                return SentEmail(
-                    id=row["id"],
-                    thread_id=row["thread_id"],
-                    message_id=row["message_id"],
-                    prospect_email=row["prospect_email"],
-                    prospect_name=row["prospect_name"],
-                    company=row["company"],
-                    subject=row["subject"],
-                    body=row["body"],
-                    sent_at=datetime.fromisoformat(row["sent_at"]),
-                    label=row["label"]
-                )
-            return None
+        with self._lock:
+            conn = self._conn
+            row = conn.execute(SQL_GET_BY_THREAD, (thread_id,)).fetchone()
+
+        if row:
+            return self._row_to_sent_email(row)
+        return None
 
     def save_reply(self, reply: EmailReply) -> int:
-        """Save email reply to database, return the inserted ID."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                INSERT OR IGNORE INTO replies 
-                (sent_email_id, message_id, from_email, reply_content, received_at, processed)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                reply.sent_email_id,
-                reply.message_id,
-                reply.from_email,
-                reply.reply_content,
-                reply.received_at,
-                reply.processed
-            ))
-            return cursor.lastrowid
+        """Save email reply to database, return its ID.
+
+        Idempotent: if a reply with the same message_id is already stored,
+        the existing row's ID is returned.
+        """
+        with self._lock:
+            conn = self._conn
+            params = self._reply_row(reply)
+            if SQLITE_HAS_RETURNING:
+                row = conn.execute(SQL_INSERT_REPLY_RETURNING, params).fetchone()
+                if row:
+                    return row[0]
+            else:
+                cursor = conn.execute(SQL_INSERT_REPLY, params)
+                if cursor.rowcount:
+                    return cursor.lastrowid
+            return conn.execute(SQL_REPLY_ID_BY_MESSAGE, (reply.message_id,)).fetchone()[0]
+
+    def save_replies_bulk(self, replies: List[EmailReply]) -> List[int]:
+        """Save many replies in a single transaction, return their IDs in input order."""
+        if not replies:
+            return []
+        with self._lock:
+            conn = self._conn
+            self._executemany_in_transaction(SQL_INSERT_REPLY, [self._reply_row(r) for r in replies])
+            # lastrowid is meaningless after executemany (and rows may have been ignored
+            # as duplicates), so look the IDs up by message_id, one query per chunk
+            message_ids = [r.message_id for r in replies]
+            ids_by_message: Dict[str, int] = {}
+            for start in range(0, len(message_ids), SQL_MAX_PARAMS):
+                chunk = message_ids[start:start + SQL_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                ids_by_message.update(conn.execute(SQL_REPLY_IDS_BY_MESSAGE.format(placeholders=placeholders), chunk).fetchall())
+            return [ids_by_message[message_id] for message_id in message_ids]
+
+    def reply_exists(self, message_id: str) -> bool:
+        """Check whether a reply (processed or not) is already stored."""
+        with self._lock:
+            return self._conn.execute(SQL_REPLY_EXISTS, (message_id,)).fetchone() is not None
 
     def get_new_replies(self) -> List[EmailReply]:
         """Get all unprocessed replies."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            rows = conn.execute("""
-                SELECT r.*, se.company, se.prospect_name, se.subject 
-                FROM replies r 
-                JOIN sent_emails se ON r.sent_email_id = se.id 
-                WHERE r.processed = FALSE 
-                ORDER BY r.received_at DESC
-            """).fetchall()
+        with self._lock:
+            conn = self._conn
+            rows = conn.execute(SQL_NEW_REPLIES).fetchall()
             
             return [
                 EmailReply(
@@ -181,32 +351,78 @@ class EmailDatabase:
                     message_id=row["message_id"],
                     from_email=row["from_email"],
                     reply_content=row["reply_content"],
-                    received_at=datetime.fromisoformat(row["received_at"]),
+                    received_at=row["received_at"],
                     processed=bool(row["processed"])
                 ) for row in rows
             ]
 
     def mark_reply_processed(self, reply_id: int):
         """Mark a reply as processed."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("UPDATE replies SET processed = TRUE WHERE id = ?", (reply_id,))
+        with self._lock:
+            conn = self._conn
+            conn.execute(SQL_MARK_PROCESSED, (reply_id,))
+
+    def mark_replies_processed(self, reply_ids: List[int]):
+        """Mark several replies as processed in a single transaction."""
+        if not reply_ids:
+            return
+        with self._lock, self._write_transaction() as conn:
+            for start in range(0, len(reply_ids), SQL_MAX_PARAMS):
+                chunk = reply_ids[start:start + SQL_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                conn.execute(SQL_MARK_PROCESSED_MANY.format(placeholders=placeholders), chunk)
 
     def get_stats(self) -> Dict[str, Any]:
         """Get database statistics."""
-        with sqlite3.connect(self.db_path) as conn:
-            sent_count = conn.execute("SELECT COUNT(*) FROM sent_emails").fetchone()[0]
-            reply_count = conn.execute("SELECT COUNT(*) FROM replies").fetchone()[0]
-            new_replies = conn.execute("SELECT COUNT(*) FROM replies WHERE processed = FALSE").fetchone()[0]
-            
-            return {
-                "total_sent": sent_count,
-                "total_replies": reply_count,
-                "new_replies": new_replies,
-                "response_rate": round((reply_count / sent_count * 100), 2) if sent_count > 0 else 0
-            }
+        with self._lock:
+            conn = self._conn
+            row = conn.execute(SQL_STATS).fetchone()
+
+        sent_count = row["sent"]
+        reply_count = row["total"]
+        # SUM() over an empty table is NULL
+        new_replies = row["new_replies"] or 0
+
+        return {
+            "total_sent": sent_count,
+            "total_replies": reply_count,
+            "new_replies": new_replies,
+            "response_rate": round((reply_count / sent_count * 100), 2) if sent_count > 0 else 0
+        }
 
     def get_thread_ids_for_monitoring(self) -> List[str]:
         """Get all thread IDs that should be monitored for replies."""
-        with sqlite3.connect(self.db_path) as conn:
-            rows = conn.execute("SELECT DISTINCT thread_id FROM sent_emails").fetchall()
-            return [row[0] for row in rows]
\ No newline at end of file
+        with self._lock:
+            conn = self._conn
+            rows = conn.execute(SQL_THREAD_IDS).fetchall()
+            return [row[0] for row in rows]
+
+    def get_last_history_id(self) -> Optional[str]:
+        """Get the Gmail historyId of the last completed reply check, if any."""
+        with self._lock:
+            row = self._conn.execute(SQL_GET_META, (META_LAST_HISTORY_ID,)).fetchone()
+        return row[0] if row else None
+
+    def get_retry_thread_ids(self) -> List[str]:
+        """Get the thread IDs the last reply check could not read (to scan again)."""
+        with self._lock:
+            row = self._conn.execute(SQL_GET_META, (META_RETRY_THREAD_IDS,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def get_untracked_threads(self) -> Dict[str, float]:
+        """Get threads seen in the Gmail history before they were tracked, with first-seen times."""
+        with self._lock:
+            row = self._conn.execute(SQL_GET_META, (META_UNTRACKED_THREADS,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_reply_sync_state(
+        self, history_id: str, retry_thread_ids: List[str], untracked_threads: Dict[str, float]
+    ):
+        """Store the historyId a reply check caught up to, the threads it must retry
+        and the untracked threads it saw (see get_untracked_threads)."""
+        with self._lock, self._write_transaction() as conn:
+            conn.executemany(SQL_SET_META, [
+                (META_LAST_HISTORY_ID, str(history_id)),
+                (META_RETRY_THREAD_IDS, json.dumps(sorted(retry_thread_ids))),
+                (META_UNTRACKED_THREADS, json.dumps(untracked_threads)),
+            ])
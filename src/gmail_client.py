@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import base64
+from email.header import Header
 from email.message import EmailMessage
-from typing import Optional, List
+from email.utils import formataddr, parseaddr
+from typing import Dict, Optional, List, Tuple
 
 try:
     import backoff  # type: ignore
@@ -16,6 +18,11 @@ except Exception:  # pragma: no cover
 
 import os
 import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.send",
@@ -26,6 +33,56 @@ SCOPES = [
 TOKEN_PATH = os.path.join(os.path.dirname(__file__), "..", "token.json")
 CRED_PATH = os.path.join(os.path.dirname(__file__), "..", "credentials.json")
 
+# Gmail allows 250 quota units per user per second; these are the per-call costs
+GMAIL_QUOTA_UNITS_PER_SEC = 250
+SEND_QUOTA_UNITS = 100
+MODIFY_QUOTA_UNITS = 5
+GET_QUOTA_UNITS = 5
+THREAD_GET_QUOTA_UNITS = 10
+# Headers requested for format="metadata" fetches (enough to detect replies)
+METADATA_HEADERS = ["From", "Date", "Subject", "Message-ID", "In-Reply-To", "References"]
+# Gmail accepts up to 100 sub-requests per batch but advises at most 50; 50 gets
+# are also exactly one second of quota (50 * 5 = 250 units)
+BATCH_MAX_REQUESTS = 50
+# Attempts for a threads.get, or per batched message, rejected with 429 or 5xx
+BATCH_MAX_TRIES = 4
+
+
+class RateLimiter:
+    """Thread-safe token bucket: acquire(n) blocks until n tokens are available."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Label name -> ID maps: in memory per service object, and on disk per account
+LABEL_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ai_emailer", "labels.json")
+_LABEL_CACHE: Dict[int, Dict[str, str]] = {}
+# Serializes label refreshes so parallel senders don't all re-create the label
+_LABEL_LOCK = threading.Lock()
+# Rejected label ID -> refreshed ID, so later sends of the run skip the stale one
+_REFRESHED_LABELS: Dict[str, str] = {}
+
+# Shared by all sending threads so parallel sends stay within the per-user quota
+gmail_quota = RateLimiter(GMAIL_QUOTA_UNITS_PER_SEC)
+_thread_local = threading.local()
+
 
 def _load_creds():
     # Lazy imports to avoid hard dependency during dry-runs
@@ -61,7 +118,66 @@ def get_service():
     return service
 
 
-def ensure_label(service, label_name: str) -> str:
+def get_thread_service():
+    """Get a Gmail service owned by the calling thread.
+
+    googleapiclient service objects wrap an httplib2 connection that is not
+    thread-safe, so every worker thread builds (and then reuses) its own.
+    """
+    service = getattr(_thread_local, "service", None)
+    if service is None:
+        service = _thread_local.service = get_service()
+    return service
+
+
+def _http_status(exception: BaseException) -> Optional[int]:
+    """HTTP status of a googleapiclient HttpError (None for other errors)."""
+    return getattr(getattr(exception, "resp", None), "status", None)
+
+
+def _is_retryable(exception: BaseException) -> bool:
+    status = _http_status(exception)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _read_label_cache() -> Dict[str, Dict[str, str]]:
+    try:
+        with open(LABEL_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_label_cache(account: str, labels: Optional[Dict[str, str]]):
+    """Store (or, with labels=None, forget) the label map of one account."""
+    data = _read_label_cache()
+    if labels is None:
+        data.pop(account, None)
+    else:
+        data[account] = labels
+    try:
+        os.makedirs(os.path.dirname(LABEL_CACHE_PATH), exist_ok=True)
+        with open(LABEL_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+    except OSError:
+        pass  # The cache is only an optimization
+
+
+def ensure_label(service, label_name: str, account: Optional[str] = None) -> str:
+    """Return the ID of label_name, creating the label if it doesn't exist.
+
+    Label IDs are cached per service object and, when account is given, in
+    LABEL_CACHE_PATH across runs. send_message() refreshes a cached ID that
+    Gmail rejects, e.g. after the label was removed in Gmail.
+    """
+    cached = _LABEL_CACHE.get(id(service))
+    if cached is None and account:
+        cached = _read_label_cache().get(account)
+        if cached is not None:
+            _LABEL_CACHE[id(service)] = cached
+    if cached and label_name in cached:
+        return cached[label_name]
+
     try:
         labels = service.users().labels().list(userId="me").execute().get("labels", [])
     except Exception as e:
@@ -76,44 +192,126 @@ def ensure_label(service, label_name: str) -> str:
                 "Insufficient OAuth scopes. Delete token.json and re-authorize to grant both gmail.send and gmail.labels."
             ) from e
         raise
-    for lbl in labels:
-        if lbl.get("name") == label_name:
-            return lbl.get("id")
-    body = {
-        "name": label_name,
-        "labelListVisibility": "labelShow",
-        "messageListVisibility": "show"
-    }
-    created = service.users().labels().create(userId="me", body=body).execute()
-    return created.get("id")
+    label_ids = {lbl.get("name"): lbl.get("id") for lbl in labels}
+    if label_name not in label_ids:
+        body = {
+            "name": label_name,
+            "labelListVisibility": "labelShow",
+            "messageListVisibility": "show"
+        }
+        created = service.users().labels().create(userId="me", body=body).execute()
+        label_ids[label_name] = created.get("id")
+
+    _LABEL_CACHE[id(service)] = label_ids
+    if account:
+        _write_label_cache(account, label_ids)
+    return label_ids[label_name]
+
+
+def _refresh_label(service, label_name: str, stale_id: str, account: Optional[str]) -> str:
+    """Forget a label ID Gmail rejected and resolve label_name again (creating it if needed)."""
+    with _LABEL_LOCK:
+        # Another sending thread may have refreshed it already
+        if stale_id in _REFRESHED_LABELS:
+            return _REFRESHED_LABELS[stale_id]
+        _LABEL_CACHE.pop(id(service), None)
+        if account:
+            _write_label_cache(account, None)
+        _REFRESHED_LABELS[stale_id] = ensure_label(service, label_name, account=account)
+        return _REFRESHED_LABELS[stale_id]
+
+
+def _is_invalid_label_error(exception: BaseException) -> bool:
+    return _http_status(exception) in (400, 404) and "label" in str(exception).lower()
+
+
+def _header_value(value: str) -> str:
+    # Headers must be a single line; RFC 2047-encode non-ASCII text only when needed
+    value = " ".join(value.splitlines())
+    return value if value.isascii() else Header(value, "utf-8").encode(linesep="\r\n")
+
+
+def _address_header(value: str) -> str:
+    value = " ".join(value.splitlines())
+    if value.isascii():
+        return value
+    name, addr = parseaddr(value)
+    return formataddr((name, addr), charset="utf-8") if addr else _header_value(value)
 
 
 def _build_message(sender_header: str, to: str, subject: str, body_text: str) -> dict:
-    msg = EmailMessage()
-    msg["To"] = to
-    msg["From"] = sender_header
-    msg["Subject"] = subject
-    msg.set_content(body_text)
+    body = "\r\n".join(body_text.splitlines()).encode("utf-8")
+    if any(len(line) > 998 for line in body.split(b"\r\n")):
+        # 8bit bodies are limited to 998 octets per line; let the email package pick an encoding
+        msg = EmailMessage()
+        msg["To"] = " ".join(to.splitlines())
+        msg["From"] = " ".join(sender_header.splitlines())
+        msg["Subject"] = " ".join(subject.splitlines())
+        msg.set_content(body_text)
+        return {"raw": base64.urlsafe_b64encode(msg.as_bytes()).decode()}
 
-    raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
+    # Plain-text messages with simple headers: assemble the MIME bytes directly,
+    # which is much cheaper than serializing an EmailMessage
+    head = (
+        f"To: {_address_header(to)}\r\n"
+        f"From: {_address_header(sender_header)}\r\n"
+        f"Subject: {_header_value(subject)}\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/plain; charset=\"utf-8\"\r\n"
+        "Content-Transfer-Encoding: 8bit\r\n"
+        "\r\n"
+    ).encode("ascii")
+    raw = base64.urlsafe_b64encode(head + body + b"\r\n").decode("ascii")
     return {"raw": raw}
 
 
 @backoff.on_exception(getattr(backoff, "expo", None), Exception, max_tries=5)
-def send_message(service, to_email: str, subject: str, body: str, label_id: Optional[str], sender_header: Optional[str] = None) -> dict:
+def _send_raw(service, message: dict) -> dict:
+    gmail_quota.acquire(SEND_QUOTA_UNITS)
+    return service.users().messages().send(userId="me", body=message).execute()
+
+
+def _apply_label(service, message_id: str, label_id: str):
+    gmail_quota.acquire(MODIFY_QUOTA_UNITS)
+    service.users().messages().modify(
+        userId="me",
+        id=message_id,
+        body={"addLabelIds": [label_id]},
+    ).execute()
+
+
+def send_message(
+    service,
+    to_email: str,
+    subject: str,
+    body: str,
+    label_id: Optional[str],
+    sender_header: Optional[str] = None,
+    label_name: Optional[str] = None,
+    account: Optional[str] = None,
+) -> dict:
+    """Send one email and apply label_id to it.
+
+    Only the send itself is retried, so a failing label step never sends the
+    email twice. If Gmail rejects label_id and label_name is given, the label
+    is looked up again (see ensure_label) and applied once more.
+    """
     message = _build_message(sender_header or "me", to_email, subject, body)
-    sent = service.users().messages().send(userId="me", body=message).execute()
+    sent = _send_raw(service, message)
     
     # Get thread ID for tracking
     thread_id = sent.get("threadId")
     
     if label_id:
+        label_id = _REFRESHED_LABELS.get(label_id, label_id)
         try:
-            service.users().messages().modify(
-                userId="me",
-                id=sent["id"],
-                body={"addLabelIds": [label_id]},
-            ).execute()
+            try:
+                _apply_label(service, sent["id"], label_id)
+            except Exception as e:
+                if not (label_name and _is_invalid_label_error(e)):
+                    raise
+                logger.warning("Label ID %s was rejected, looking up label %r again", label_id, label_name)
+                _apply_label(service, sent["id"], _refresh_label(service, label_name, label_id, account))
         except Exception as e:
             msg = str(e)
             if "insufficientPermissions" in msg or "Insufficient Permission" in msg:
@@ -121,21 +319,76 @@ def send_message(service, to_email: str, subject: str, body: str, label_id: Opti
                     "Email sent but label could not be applied due to insufficient OAuth scopes. "
                     "Delete token.json and re-run to re-authorize with scopes: gmail.send, gmail.labels."
                 ) from e
-            raise
+            # The email went out; keep it (and its tracking record) rather than fail the send
+            logger.warning("Email %s sent but label could not be applied: %s", sent.get("id"), e)
     
     # Add thread_id to response for database tracking
     sent["threadId"] = thread_id
     return sent
 
 
-def get_thread_messages(service, thread_id: str) -> List[dict]:
-    """Get all messages in a Gmail thread."""
-    try:
-        thread = service.users().threads().get(userId="me", id=thread_id).execute()
+def get_thread_messages(service, thread_id: str, format: str = "metadata") -> List[dict]:
+    """Get all messages in a Gmail thread.
+
+    Defaults to format="metadata" (headers only, no MIME bodies); pass
+    format="full" when the message bodies are needed. A thread that no longer
+    exists (HTTP 404) has no messages. 429 and 5xx responses are retried with
+    exponential backoff; other API errors, or retries running out, are raised
+    so callers can retry the thread later.
+    """
+    for attempt in range(BATCH_MAX_TRIES):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        # Thread scans run in parallel, so they share the per-user quota with sends and batches
+        gmail_quota.acquire(THREAD_GET_QUOTA_UNITS)
+        try:
+            # metadataHeaders only applies to format="metadata" and is ignored otherwise
+            thread = service.users().threads().get(
+                userId="me", id=thread_id, format=format, metadataHeaders=METADATA_HEADERS
+            ).execute()
+        except Exception as e:
+            if _http_status(e) == 404:
+                logger.warning("Thread %s no longer exists", thread_id)
+                return []
+            if attempt + 1 < BATCH_MAX_TRIES and _is_retryable(e):
+                continue
+            raise
         return thread.get("messages", [])
+
+
+def get_history_id(service) -> str:
+    """Get the mailbox's current historyId (the starting point for list_history)."""
+    return service.users().getProfile(userId="me").execute()["historyId"]
+
+
+def list_history(service, start_history_id: str) -> Optional[Tuple[List[dict], str]]:
+    """List messages added to the mailbox since start_history_id.
+
+    Returns (messages, history_id): the added messages as {"id", "threadId"}
+    dicts and the historyId to resume from next time. Returns None when Gmail
+    no longer has history that far back (HTTP 404), so the caller has to do a
+    full scan instead.
+    """
+    messages: List[dict] = []
+    page_token = None
+    try:
+        while True:
+            response = service.users().history().list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded"],
+                pageToken=page_token,
+            ).execute()
+            for record in response.get("history", []):
+                messages.extend(added["message"] for added in record.get("messagesAdded", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return messages, response.get("historyId", start_history_id)
     except Exception as e:
-        print(f"Error getting thread {thread_id}: {e}")
-        return []
+        if _http_status(e) == 404:
+            logger.info("History %s has expired, doing a full scan", start_history_id)
+            return None
+        raise
 
 
 def get_message_content(service, message_id: str) -> dict:
@@ -144,5 +397,52 @@ def get_message_content(service, message_id: str) -> dict:
         message = service.users().messages().get(userId="me", id=message_id, format="full").execute()
         return message
     except Exception as e:
-        print(f"Error getting message {message_id}: {e}")
+        logger.warning("Error getting message %s: %s", message_id, e)
         return {}
+
+
+def get_messages_batch(
+    service, message_ids: List[str], format: str = "full", failed: Optional[List[str]] = None
+) -> Dict[str, dict]:
+    """Get several Gmail messages using batch HTTP requests (up to 50 per round trip).
+
+    Sub-requests rejected with 429 or 5xx are retried with exponential backoff.
+    Returns a dict of message ID to message; messages that could not be loaded
+    are left out. IDs that failed for any reason other than the message no
+    longer existing (HTTP 404) are appended to failed, if given.
+    """
+    results: Dict[str, dict] = {}
+    retry: List[str] = []
+    errors: List[str] = failed if failed is not None else []
+
+    def _collect(request_id, response, exception):
+        if exception is None:
+            results[request_id] = response
+        elif _is_retryable(exception):
+            retry.append(request_id)
+        else:
+            logger.warning("Error getting message %s: %s", request_id, exception)
+            if _http_status(exception) != 404:
+                errors.append(request_id)
+
+    remaining = list(message_ids)
+    for attempt in range(BATCH_MAX_TRIES):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        for start in range(0, len(remaining), BATCH_MAX_REQUESTS):
+            chunk = remaining[start:start + BATCH_MAX_REQUESTS]
+            gmail_quota.acquire(GET_QUOTA_UNITS * len(chunk))
+            batch = service.new_batch_http_request(callback=_collect)
+            for message_id in chunk:
+                batch.add(
+                    service.users().messages().get(userId="me", id=message_id, format=format),
+                    request_id=message_id,
+                )
+            batch.execute()
+        if not retry:
+            break
+        remaining, retry[:] = list(retry), []
+    else:
+        logger.warning("Giving up on %d message(s) after %d tries: %s", len(remaining), BATCH_MAX_TRIES, ", ".join(remaining))
+        errors.extend(remaining)
+    return results
@@ -1,55 +1,74 @@
 from __future__ import annotations
 
 import argparse
+import csv
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
 
 from .config_loader import load_config
-from .gmail_client import get_service, ensure_label, send_message
-from .writer import CampaignConfig, Prospect, simple_template, gemini_generate
+from .gmail_client import get_service, get_thread_service, ensure_label, send_message
+from .writer import CampaignConfig, Prospect, compile_template, render_template, gemini_generate_batch
 from .database import EmailDatabase, SentEmail
 from datetime import datetime
 
+# Sent emails are written to the database in batches of this size (and at end of run)
+DB_FLUSH_SIZE = 500
+# Parallel Gmail sends; the shared quota limiter in gmail_client caps throughput
+DEFAULT_WORKERS = 8
+
 
 def load_prospects(csv_path: str) -> List[Prospect]:
-    try:
-        import pandas as pd  # type: ignore
-        df = pd.read_csv(csv_path)
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
         req_cols = {"company", "contact_name", "email"}
-        missing = req_cols - set(df.columns)
+        missing = req_cols - set(reader.fieldnames or [])
         if missing:
             raise ValueError(f"CSV mist kolommen: {', '.join(sorted(missing))}")
-        prospects: List[Prospect] = []
-        for _, row in df.iterrows():
-            prospects.append(
-                Prospect(
-                    company=str(row.get("company", "")).strip(),
-                    contact_name=str(row.get("contact_name", "")).strip(),
-                    email=str(row.get("email", "")).strip(),
-                    notes=str(row.get("notes", "")).strip(),
-                )
+        return [
+            Prospect(
+                company=(row.get("company") or "").strip(),
+                contact_name=(row.get("contact_name") or "").strip(),
+                email=(row.get("email") or "").strip(),
+                notes=(row.get("notes") or "").strip(),
             )
-        return prospects
-    except Exception:
-        # Fallback CSV loader without pandas
-        import csv
-        prospects: List[Prospect] = []
-        with open(csv_path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            req_cols = {"company", "contact_name", "email"}
-            missing = req_cols - set(reader.fieldnames or [])
-            if missing:
-                raise ValueError(f"CSV mist kolommen: {', '.join(sorted(missing))}")
-            for row in reader:
-                prospects.append(
-                    Prospect(
-                        company=(row.get("company") or "").strip(),
-                        contact_name=(row.get("contact_name") or "").strip(),
-                        email=(row.get("email") or "").strip(),
-                        notes=(row.get("notes") or "").strip(),
-                    )
-                )
-        return prospects
+            for row in reader
+        ]
+
+
+def _compose_all(
+    prospects: List[Prospect], cfg, camp_cfg: CampaignConfig, template: tuple[str, str], from_display: str
+) -> List[tuple[str, str]]:
+    """Generate (subject, body) for every prospect, in order."""
+    if cfg.gemini.api_key:
+        generated = gemini_generate_batch(cfg.gemini.api_key, cfg.gemini.model, camp_cfg, prospects)
+        # Fill placeholder
+        return [(subject, body.replace("{FROM_NAME}", from_display)) for subject, body in generated]
+    # The compiled template already contains the sender name
+    return [render_template(template, p) for p in prospects]
+
+
+def _send_one(
+    p: Prospect, subject: str, body: str, sender_header: str, label_id: str, label: str, account: str
+) -> SentEmail:
+    """Send the email for one prospect (runs in a worker thread)."""
+    sent = send_message(
+        get_thread_service(), p.email, subject, body, label_id,
+        sender_header=sender_header, label_name=label, account=account,
+    )
+    return SentEmail(
+        id=None,
+        thread_id=sent.get("threadId", ""),
+        message_id=sent.get("id", ""),
+        prospect_email=p.email,
+        prospect_name=p.contact_name,
+        company=p.company,
+        subject=subject,
+        body=body,
+        sent_at=datetime.now(),
+        label=label
+    )
 
 
 def main():
@@ -58,8 +77,11 @@ def main():
     parser.add_argument("--dry-run", action="store_true", help="Genereer en toon emails maar verzend niet")
     parser.add_argument("--limit", type=int, default=None, help="Maximaal aantal prospects om te verwerken")
     parser.add_argument("--only-email", type=str, default=None, help="Alleen deze email verzenden (filter)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"Aantal parallelle verzendingen (default: {DEFAULT_WORKERS})")
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     cfg = load_config(os.path.join(os.path.dirname(__file__), "..", "config.toml"))
 
     # Initialize database
@@ -70,7 +92,7 @@ def main():
     if not args.dry_run:
         try:
             service = get_service()
-            label_id = ensure_label(service, cfg.gmail.label)
+            label_id = ensure_label(service, cfg.gmail.label, account=cfg.gmail.from_email)
         except RuntimeError as e:
             print("Fout tijdens Gmail setup:")
             print(str(e))
@@ -94,53 +116,72 @@ def main():
         cta=cfg.campaign.cta,
     )
 
-    use_gemini = bool(cfg.gemini.api_key)
+    # Constant for the whole run: compute once instead of per prospect
+    sender_header = f"{cfg.gmail.from_name} <{cfg.gmail.from_email}>" if cfg.gmail.from_name else cfg.gmail.from_email
+    from_display = cfg.gmail.from_name or cfg.gmail.from_email
+    template = compile_template(camp_cfg, from_name=from_display)
 
-    for p in prospects:
-        if use_gemini:
-            subject, body = gemini_generate(cfg.gemini.api_key, cfg.gemini.model, camp_cfg, p)
-        else:
-            subject, body = simple_template(camp_cfg, p)
+    contents = _compose_all(prospects, cfg, camp_cfg, template, from_display)
 
-        # personalize From header
-        sender_header = f"{cfg.gmail.from_name} <{cfg.gmail.from_email}>" if cfg.gmail.from_name else cfg.gmail.from_email
-
-        # Fill placeholder
-        body = body.replace("{FROM_NAME}", cfg.gmail.from_name or cfg.gmail.from_email)
-
-        if args.dry_run:
+    if args.dry_run:
+        for p, (subject, body) in zip(prospects, contents):
             print("--- DRY RUN ---")
             print("To:", p.email)
             print("Subject:", subject)
             print("Body:\n", body)
             print("Label:", cfg.gmail.label)
             print()
-            continue
-
-        try:
-            sent = send_message(service, p.email, subject, body, label_id, sender_header=sender_header)
-            
-            # Save to database for reply tracking
-            sent_email = SentEmail(
-                id=None,
-                thread_id=sent.get("threadId", ""),
-                message_id=sent.get("id", ""),
-                prospect_email=p.email,
-                prospect_name=p.contact_name,
-                company=p.company,
-                subject=subject,
-                body=body,
-                sent_at=datetime.now(),
-                label=cfg.gmail.label
-            )
-            db.save_sent_email(sent_email)
-            
-            print(f"Sent to {p.email}: https://mail.google.com/mail/u/0/#sent/{sent.get('id')}")
-            print(f"Saved to database for reply tracking")
-        except RuntimeError as e:
-            print(str(e))
-            return
+        return
 
+    pending: List[SentEmail] = []
+
+    def flush_pending():
+        if pending:
+            db.save_sent_emails_bulk(pending)
+            print(f"Saved {len(pending)} email(s) to database for reply tracking")
+            pending.clear()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    futures = [
+        executor.submit(
+            _send_one, p, subject, body, sender_header, label_id, cfg.gmail.label, cfg.gmail.from_email
+        )
+        for p, (subject, body) in zip(prospects, contents)
+    ]
+    handled = set()
+    try:
+        for future in as_completed(futures):
+            handled.add(future)
+            if future.cancelled():
+                continue
+            try:
+                sent_email = future.result()
+            except Exception as e:
+                print(str(e))
+                # Stop queued sends; in-flight ones still finish and get saved
+                for f in futures:
+                    f.cancel()
+                continue
+
+            # Queue for the database (reply tracking); flushed in batches
+            pending.append(sent_email)
+            if len(pending) >= DB_FLUSH_SIZE:
+                flush_pending()
+
+            print(f"Sent to {sent_email.prospect_email}: https://mail.google.com/mail/u/0/#sent/{sent_email.message_id}")
+    except BaseException:
+        # Ctrl-C or a database error: drop the queued sends instead of letting the
+        # executor run them all, wait for the in-flight ones and keep those too
+        executor.shutdown(wait=True, cancel_futures=True)
+        pending.extend(
+            f.result() for f in futures
+            if f not in handled and f.done() and not f.cancelled() and f.exception() is None
+        )
+        raise
+    finally:
+        executor.shutdown()
+        # Always persist what was actually sent, even when the run is aborted
+        flush_pending()
 
 if __name__ == "__main__":
     main()
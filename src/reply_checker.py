@@ -1,42 +1,155 @@
 from __future__ import annotations
 
 import base64
-from typing import List, Optional
-from datetime import datetime
+import html
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+from typing import List, Optional, Tuple
+from datetime import datetime, timezone
+from email.utils import parseaddr
 import re
+import time
 
-from .gmail_client import get_service, get_thread_messages, get_message_content
-from .database import EmailDatabase, EmailReply
+try:
+    from selectolax.lexbor import LexborHTMLParser  # type: ignore
+except Exception:  # pragma: no cover
+    LexborHTMLParser = None  # type: ignore
+
+from .gmail_client import (
+    get_service,
+    get_thread_service,
+    get_thread_messages,
+    get_messages_batch,
+    get_history_id,
+    list_history,
+)
+from .database import EmailDatabase, EmailReply, SentEmail
+
+logger = logging.getLogger(__name__)
+
+# Concurrent threads.get requests while scanning for replies
+THREAD_FETCH_WORKERS = 10
+# main.py records sent emails in batches, so a thread can show up in the Gmail
+# history before it is tracked. Such threads are remembered this long (seconds)
+# and scanned once their sent email is in the database.
+UNTRACKED_THREAD_TTL = 24 * 3600
+
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+_HTML_SCRIPT_RE = re.compile(r'<(script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+
+# HTML to text: block elements and <br> leave marker characters in the text,
+# which become newlines once the source whitespace has been collapsed
+_HTML_BLOCK_TAGS = (
+    "address", "article", "blockquote", "dd", "div", "dl", "dt", "footer", "h1", "h2", "h3",
+    "h4", "h5", "h6", "header", "hr", "li", "ol", "p", "pre", "section", "table", "tr", "ul",
+)
+_HTML_BLOCK_SELECTOR = ", ".join(_HTML_BLOCK_TAGS)
+_BLOCK_MARK = "\x00"
+_BR_MARK = "\x01"
+_HTML_BREAK_RE = re.compile(r'<(br|/?(?:%s))\b[^>]*>' % "|".join(_HTML_BLOCK_TAGS), re.IGNORECASE)
+# HTML's collapsible whitespace (not NBSP, which is content)
+_HTML_SPACE_RE = re.compile(r'[ \t\r\n\f]+')
+_MARK_RUN_RE = re.compile(r' ?[\x00\x01][ \x00\x01]*')
+
+# Start of quoted content, as one alternation so a single scan finds the earliest marker:
+# "On ... wrote:", Dutch "Op ... schreef:", email headers (From:/Van:), "> " quote
+# lines and Outlook's "-----Original Message-----". The non-greedy arms keep
+# re.DOTALL from running past the first attribution line.
+_QUOTE_PATTERN = r'\n\s*(?:On\s+.*?wrote:|Op\s+.*?schreef:|From:|Van:|>|-----Original Message-----)'
+_QUOTE_RE = re.compile(_QUOTE_PATTERN, re.IGNORECASE | re.DOTALL)
+# The same pattern for ASCII-only plain-text bodies, searched before decoding. Bytes
+# \s is only [ \t\n\r\f\v]; str \s also matches \x1c-\x1f, so add those. (Non-ASCII
+# whitespace such as NBSP can only occur in non-ASCII bodies, which use _QUOTE_RE.)
+_ASCII_SPACE_B = rb'[\s\x1c-\x1f]'
+_QUOTE_RE_B = re.compile(_QUOTE_PATTERN.encode().replace(rb'\s', _ASCII_SPACE_B), re.IGNORECASE | re.DOTALL)
+_LEADING_WS_RE_B = re.compile(_ASCII_SPACE_B + rb'*')
+# Lowercase bytes every _QUOTE_RE_B match contains, one per arm ("-----" covers the
+# Outlook separator). An ASCII body whose lowercased form (re.IGNORECASE) has none
+# of them, or no newline after the text starts, cannot match: the regex is skipped.
+_QUOTE_MARKERS = (b"wrote:", b"schreef:", b"from:", b"van:", b">", b"-----")
+
+
+def _mark_runs_to_newlines(match: re.Match) -> str:
+    # Each <br> is a line break; any number of block edges together are one
+    run = match.group()
+    return "\n" * (run.count(_BR_MARK) + (_BLOCK_MARK in run))
+
+
+def _html_to_text(raw_html: bytes) -> str:
+    """Convert an HTML body to plain text, with line breaks at blocks and <br>."""
+    if LexborHTMLParser is not None:
+        tree = LexborHTMLParser(raw_html)
+        tree.strip_tags(["script", "style"])
+        for node in tree.css(_HTML_BLOCK_SELECTOR):
+            node.insert_before(_BLOCK_MARK)
+            node.insert_after(_BLOCK_MARK)
+        for node in tree.css("br"):
+            node.insert_after(_BR_MARK)
+        text = tree.text(separator="", strip=False)
+    else:
+        # Fallback without selectolax: mark breaks, strip tags and decode entities
+        text = _HTML_BREAK_RE.sub(
+            lambda m: _BR_MARK if m.group(1).lower() == "br" else _BLOCK_MARK,
+            _HTML_SCRIPT_RE.sub('', raw_html.decode("utf-8", errors="ignore")),
+        )
+        text = html.unescape(_HTML_TAG_RE.sub('', text))
+    # Newlines only where the markup put them, so quote markers start a line
+    text = _MARK_RUN_RE.sub(_mark_runs_to_newlines, _HTML_SPACE_RE.sub(" ", text))
+    return text.strip()
+
+
+def _is_attachment(part: dict) -> bool:
+    """Whether a MIME part is an attached file rather than message text."""
+    if part.get("filename"):
+        return True
+    return any(
+        h.get("name", "").lower() == "content-disposition" and h.get("value", "").lower().startswith("attachment")
+        for h in part.get("headers", ())
+    )
+
+
+def extract_bytes_from_payload(payload: dict) -> Tuple[bytes, str]:
+    """Return the raw decoded body bytes and mime type of a Gmail message payload.
+
+    Walks the MIME tree in document order and decodes a single part: the
+    first text/plain part of the message, else the first text/html part. (So
+    the body in a nested multipart/alternative wins over a footer or
+    disclaimer part appended after it.)
+    Attachments (e.g. an attached notes.txt) are never picked. Returns
+    (b"", "") when the payload has no text body.
+    """
+    plain_part = None
+    html_part = None
+    queue = deque([payload])
+    while queue:
+        part = queue.popleft()
+        mime_type = part.get("mimeType", "")
+        if mime_type.startswith("multipart/"):
+            # Children go in front, in order: a depth-first, document-order walk
+            queue.extendleft(reversed(part.get("parts", ())))
+        elif not part.get("body", {}).get("data") or _is_attachment(part):
+            continue
+        elif mime_type == "text/plain":
+            plain_part = part
+            break
+        elif mime_type == "text/html" and html_part is None:
+            html_part = part
+
+    part = plain_part if plain_part is not None else html_part
+    if part is None:
+        return b"", ""
+    return base64.urlsafe_b64decode(part["body"]["data"]), part["mimeType"]
 
 
 def extract_text_from_payload(payload: dict) -> str:
     """Extract plain text from Gmail message payload."""
-    text = ""
-    
-    # Check if it's a simple text message
-    if payload.get("mimeType") == "text/plain":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            text = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-    
-    # Check if it's HTML (fallback)
-    elif payload.get("mimeType") == "text/html":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            html = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-            # Simple HTML to text conversion (remove tags)
-            text = re.sub(r'<[^>]+>', '', html)
-    
-    # Handle multipart messages
-    elif payload.get("mimeType", "").startswith("multipart/"):
-        parts = payload.get("parts", [])
-        for part in parts:
-            part_text = extract_text_from_payload(part)
-            if part_text:
-                text = part_text
-                break  # Prefer first text part
-    
-    return text.strip()
+    raw, mime_type = extract_bytes_from_payload(payload)
+    if mime_type == "text/html":
+        # The parser takes the decoded bytes directly
+        return _html_to_text(raw).strip()
+    return raw.decode("utf-8", errors="ignore").strip()
 
 
 def is_reply_from_prospect(message: dict, prospect_email: str) -> bool:
@@ -44,108 +157,193 @@ def is_reply_from_prospect(message: dict, prospect_email: str) -> bool:
     headers = message.get("payload", {}).get("headers", [])
     
     # Get From header
-    from_header = ""
-    for header in headers:
-        if header.get("name", "").lower() == "from":
-            from_header = header.get("value", "").lower()
-            break
+    from_header = next((h.get("value", "") for h in headers if h.get("name", "").lower() == "from"), "")
     
-    # Check if it's from the prospect (not us)
-    return prospect_email.lower() in from_header
+    # Compare just the addr-spec, e.g. "Jan <jan@acme.nl>" -> "jan@acme.nl"
+    return parseaddr(from_header)[1].lower() == prospect_email.lower()
+
+
+def _cut_quote(full_text: str) -> str:
+    """Cut text at the earliest quote marker."""
+    full_text = full_text.strip()
+    match = _QUOTE_RE.search(full_text)
+    return (full_text[:match.start()] if match else full_text).strip()
 
 
 def parse_reply_content(message: dict) -> str:
     """Parse reply content, removing quoted original message."""
     payload = message.get("payload", {})
-    full_text = extract_text_from_payload(payload)
-    
-    if not full_text:
-        return ""
-    
-    # Common patterns to detect quoted content
-    quote_patterns = [
-        r'\n\s*On\s+.*wrote:.*',  # "On ... wrote:"
-        r'\n\s*Op\s+.*schreef:.*',  # Dutch "Op ... schreef:"  
-        r'\n\s*From:.*',  # Email headers
-        r'\n\s*Van:.*',   # Dutch "Van:"
-        r'\n\s*>.*',      # Lines starting with >
-        r'\n\s*-----Original Message-----.*',
-    ]
+    raw, mime_type = extract_bytes_from_payload(payload)
     
-    # Find the earliest quote pattern
-    reply_text = full_text
-    for pattern in quote_patterns:
-        match = re.search(pattern, full_text, re.IGNORECASE | re.DOTALL)
-        if match:
-            reply_text = full_text[:match.start()].strip()
-            break
+    if mime_type == "text/html":
+        return _cut_quote(_html_to_text(raw))
+    if not raw.isascii():
+        # Unicode whitespace (e.g. NBSP before "> ") only matches the str pattern
+        return _cut_quote(raw.decode("utf-8", errors="ignore"))
     
-    return reply_text
+    # ASCII plain text: cut at the earliest quote marker on the bytes, then decode only the
+    # kept part. Searching from the first non-space byte matches searching the stripped text.
+    start = _LEADING_WS_RE_B.match(raw).end()
+    if raw.find(b"\n", start) < 0:
+        return raw[start:].decode("utf-8", errors="ignore").strip()
+    lowered = raw.lower()
+    if not any(marker in lowered for marker in _QUOTE_MARKERS):
+        return raw[start:].decode("utf-8", errors="ignore").strip()
+    match = _QUOTE_RE_B.search(raw, start)
+    end = match.start() if match else len(raw)
+    return raw[start:end].decode("utf-8", errors="ignore").strip()
+
 
+def _has_text_body(payload: dict) -> bool:
+    """Whether a payload already carries text body data (format="full" responses do)."""
+    queue = deque([payload])
+    while queue:
+        part = queue.popleft()
+        if part.get("mimeType", "").startswith("multipart/"):
+            queue.extend(part.get("parts", ()))
+        elif (
+            part.get("mimeType", "").startswith("text/")
+            and part.get("body", {}).get("data")
+            and not _is_attachment(part)
+        ):
+            return True
+    return False
 
-def check_for_new_replies() -> List[EmailReply]:
-    """Check Gmail for new replies to tracked emails."""
+
+def _find_reply_candidates(
+    db: EmailDatabase, sent_email: SentEmail, thread_format: str = "metadata"
+) -> Optional[List[Tuple[SentEmail, dict]]]:
+    """Return (sent_email, message) for unseen prospect replies in one thread.
+
+    Returns None if the thread could not be read. Runs in a worker thread, so
+    it uses that thread's own Gmail service.
+    """
+    candidates = []
+    try:
+        # Get all messages in thread (with format="metadata" only headers; bodies are fetched for candidates)
+        messages = get_thread_messages(get_thread_service(), sent_email.thread_id, format=thread_format)
+        
+        # Look for replies from prospect
+        for message in messages:
+            message_id = message.get("id", "")
+            
+            # Skip if we already have this reply (indexed lookup on message_id)
+            if db.reply_exists(message_id):
+                continue
+            
+            # Check if it's a reply from the prospect
+            if is_reply_from_prospect(message, sent_email.prospect_email):
+                candidates.append((sent_email, message))
+                    
+    except Exception as e:
+        logger.warning("Error checking thread %s: %s", sent_email.thread_id, e)
+        return None
+    return candidates
+
+
+def check_for_new_replies(thread_format: str = "metadata", full_scan: bool = False) -> List[EmailReply]:
+    """Check Gmail for new replies to tracked emails.
+
+    Only threads with messages added since the last check (per Gmail's
+    history API) are scanned, plus threads the last check failed to read and
+    changed threads seen before their sent email was recorded.
+    The first check, or one after the stored historyId has expired or with
+    full_scan=True, scans every tracked thread.
+
+    thread_format="metadata" (default) scans threads by headers only and
+    batch-fetches bodies of candidate replies; "full" gets everything in the
+    thread request (fewer round trips, more bandwidth).
+    """
     db = EmailDatabase()
     service = get_service()
     
     new_replies = []
-    thread_ids = db.get_thread_ids_for_monitoring()
+    # Load sent emails once per poll instead of querying per thread.
+    # They come newest first, so the oldest email of a thread wins.
+    sent_by_thread = {se.thread_id: se for se in db.iter_sent_emails()}
     
-    print(f"Checking {len(thread_ids)} threads for replies...")
+    now = time.time()
+    untracked = db.get_untracked_threads()
+    last_history_id = None if full_scan else db.get_last_history_id()
+    delta = list_history(service, last_history_id) if last_history_id else None
+    if delta is not None:
+        added, history_id = delta
+        changed = {m.get("threadId") for m in added}
+        for thread_id in changed:
+            if thread_id and thread_id not in sent_by_thread:
+                untracked.setdefault(thread_id, now)
+        changed.update(db.get_retry_thread_ids())
+        # Earlier deltas' threads whose sent email has been recorded since
+        changed.update(thread_id for thread_id in untracked if thread_id in sent_by_thread)
+        to_scan = [se for thread_id, se in sent_by_thread.items() if thread_id in changed]
+    else:
+        # Take the starting point before scanning so nothing arriving mid-scan is missed
+        history_id = get_history_id(service)
+        to_scan = list(sent_by_thread.values())
     
-    for thread_id in thread_ids:
-        try:
-            # Get sent email info for this thread
-            sent_email = db.get_sent_email_by_thread_id(thread_id)
-            if not sent_email:
-                continue
-                
-            # Get all messages in thread
-            messages = get_thread_messages(service, thread_id)
-            
-            # Look for replies from prospect
-            for message in messages:
-                message_id = message.get("id", "")
-                
-                # Skip if we already have this reply
-                existing_replies = db.get_new_replies()
-                if any(r.message_id == message_id for r in existing_replies):
-                    continue
-                
-                # Check if it's a reply from the prospect
-                if is_reply_from_prospect(message, sent_email.prospect_email):
-                    # Get full message content
-                    full_message = get_message_content(service, message_id)
-                    
-                    # Parse reply content
-                    reply_content = parse_reply_content(full_message)
-                    
-                    if reply_content:
-                        # Get timestamp
-                        internal_date = int(full_message.get("internalDate", "0"))
-                        received_at = datetime.fromtimestamp(internal_date / 1000)
-                        
-                        # Create reply record
-                        reply = EmailReply(
-                            id=None,
-                            sent_email_id=sent_email.id,
-                            message_id=message_id,
-                            from_email=sent_email.prospect_email,
-                            reply_content=reply_content,
-                            received_at=received_at,
-                            processed=False
-                        )
-                        
-                        # Save to database
-                        reply_id = db.save_reply(reply)
-                        reply.id = reply_id
-                        
-                        new_replies.append(reply)
-                        print(f"New reply from {sent_email.company} ({sent_email.prospect_email})")
-                        
-        except Exception as e:
-            print(f"Error checking thread {thread_id}: {e}")
+    logger.info("Checking %d of %d threads for replies...", len(to_scan), len(sent_by_thread))
+    
+    # First pass: scan threads concurrently for candidate reply messages
+    candidates = []  # (sent_email, message)
+    # Threads to scan again next time; the historyId still moves on, so a reply
+    # in a thread that failed is only found because its thread is kept here
+    failed_threads = set()
+    with ThreadPoolExecutor(max_workers=THREAD_FETCH_WORKERS) as executor:
+        scan = partial(_find_reply_candidates, db, thread_format=thread_format)
+        for sent_email, found in zip(to_scan, executor.map(scan, to_scan)):
+            if found is None:
+                failed_threads.add(sent_email.thread_id)
+            else:
+                candidates.extend(found)
+    
+    # Only fetch messages whose body isn't in the thread response, all at once
+    missing_ids = [m.get("id", "") for _, m in candidates if not _has_text_body(m.get("payload", {}))]
+    failed_fetches: List[str] = []
+    fetched = get_messages_batch(service, missing_ids, failed=failed_fetches) if missing_ids else {}
+    failed_ids = set(failed_fetches)
+    
+    for sent_email, message in candidates:
+        message_id = message.get("id", "")
+        if message_id in failed_ids:
+            failed_threads.add(sent_email.thread_id)
             continue
+        full_message = fetched.get(message_id, message)
+        
+        # Parse reply content
+        reply_content = parse_reply_content(full_message)
+        
+        if reply_content:
+            # Get timestamp
+            internal_date = int(full_message.get("internalDate", "0"))
+            # internalDate is epoch milliseconds; keep it as an aware UTC datetime
+            received_at = datetime.fromtimestamp(internal_date // 1000, tz=timezone.utc)
+            
+            # Create reply record
+            reply = EmailReply(
+                id=None,
+                sent_email_id=sent_email.id,
+                message_id=message_id,
+                from_email=sent_email.prospect_email,
+                reply_content=reply_content,
+                received_at=received_at,
+                processed=False
+            )
+            
+            new_replies.append(reply)
+            logger.info("New reply from %s (%s)", sent_email.company, sent_email.prospect_email)
+    
+    # Save all replies found in this poll in one transaction
+    for reply, reply_id in zip(new_replies, db.save_replies_bulk(new_replies)):
+        reply.id = reply_id
+    
+    if failed_threads:
+        logger.warning("%d thread(s) could not be checked; they are retried next time", len(failed_threads))
+    # Tracked threads were scanned above; keep the rest until they expire
+    untracked = {
+        thread_id: first_seen for thread_id, first_seen in untracked.items()
+        if thread_id not in sent_by_thread and now - first_seen < UNTRACKED_THREAD_TTL
+    }
+    db.save_reply_sync_state(history_id, list(failed_threads), untracked)
     
     return new_replies
 
@@ -156,22 +354,22 @@ def get_reply_summary(replies: List[EmailReply]) -> dict:
         return {"total": 0, "companies": []}
     
     db = EmailDatabase()
-    companies = []
+    sent_by_id = {se.id: se for se in db.iter_sent_emails()}
     
-    for reply in replies:
-        sent_email = db.get_sent_emails()  # This could be optimized with a join
-        sent_info = next((se for se in sent_email if se.id == reply.sent_email_id), None)
-        
-        if sent_info:
-            companies.append({
-                "company": sent_info.company,
-                "prospect_name": sent_info.prospect_name,
-                "prospect_email": sent_info.prospect_email,
-                "subject": sent_info.subject,
-                "reply_content": reply.reply_content[:200] + "..." if len(reply.reply_content) > 200 else reply.reply_content,
-                "received_at": reply.received_at.strftime("%Y-%m-%d %H:%M"),
-                "reply_id": reply.id
-            })
+    companies = [
+        {
+            "company": sent_info.company,
+            "prospect_name": sent_info.prospect_name,
+            "prospect_email": sent_info.prospect_email,
+            "subject": sent_info.subject,
+            "reply_content": (content := reply.reply_content)[:200] + ("..." if len(content) > 200 else ""),
+            # Shown in local time (older rows are stored naive local, newer ones in UTC)
+            "received_at": reply.received_at.astimezone().strftime("%Y-%m-%d %H:%M"),
+            "reply_id": reply.id
+        }
+        for reply in replies
+        if (sent_info := sent_by_id.get(reply.sent_email_id))
+    ]
     
     return {
         "total": len(replies),
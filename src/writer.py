@@ -1,22 +1,41 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import json
+import logging
+import re
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 
 try:
     import google.generativeai as genai  # type: ignore
 except Exception:  # pragma: no cover
     genai = None  # type: ignore
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+# Greedy, so it spans from the first { to the last }
+_JSON_EXTRACT_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+# Empty CSV cells come through as "" or, from spreadsheet exports, "nan"
+_NAN_SENTINELS = frozenset(("", "nan"))
+_NAN_SENTINEL_MAX_LEN = max(map(len, _NAN_SENTINELS))
+
+
+def _is_blank(s: Optional[str]) -> bool:
+    # The length check skips lowercasing long values such as notes
+    return not s or (len(s) <= _NAN_SENTINEL_MAX_LEN and s.lower() in _NAN_SENTINELS)
+
+
+@dataclass(slots=True, frozen=True)
 class CampaignConfig:
     service_name: str
     value_prop: str
     cta: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Prospect:
     company: str
     contact_name: str
@@ -24,48 +43,76 @@ class Prospect:
     notes: str = ""
 
 
-def simple_template(cfg: CampaignConfig, p: Prospect) -> tuple[str, str]:
-    subject = f"{p.company} x {cfg.service_name}?"
-    greeting = f"Hoi {p.contact_name}," if p.contact_name and p.contact_name.lower() not in ['', 'nan'] else "Hoi,"
-    notes_text = p.notes if p.notes and p.notes.lower() not in ['', 'nan'] else "mogelijkheden voor optimalisatie"
-    body = (
-        f"{greeting}\n\n"
-        f"Ik ben bezig met {cfg.service_name.lower()} voor MKB's. {cfg.value_prop}\n\n"
-        f"Voor {p.company} zag ik: {notes_text}. "
-        f"Lijkt het interessant om hier kort over te sparren? {cfg.cta}\n\n"
-        f"Groet,\n"
-        f"{{FROM_NAME}}"
+def _escape_format(text: str) -> str:
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def compile_template(cfg: CampaignConfig, from_name: Optional[str] = None) -> tuple[str, str]:
+    """Pre-render the campaign-wide parts of the simple template.
+
+    Returns (subject_fmt, body_fmt) format strings that only have the
+    per-prospect slots {company}, {greeting} and {notes_text} left. The
+    sender name is filled in when given, otherwise {FROM_NAME} is kept.
+    """
+    subject_fmt = "{company} x " + _escape_format(cfg.service_name) + "?"
+    body_fmt = (
+        "{greeting}\n\n"
+        f"Ik ben bezig met {_escape_format(cfg.service_name.lower())} voor MKB's. {_escape_format(cfg.value_prop)}\n\n"
+        "Voor {company} zag ik: {notes_text}. "
+        f"Lijkt het interessant om hier kort over te sparren? {_escape_format(cfg.cta)}\n\n"
+        "Groet,\n"
+        + (_escape_format(from_name) if from_name else "{{FROM_NAME}}")
     )
+    return subject_fmt, body_fmt
+
+
+def render_template(template: tuple[str, str], p: Prospect) -> tuple[str, str]:
+    """Fill a compile_template() result for one prospect."""
+    subject_fmt, body_fmt = template
+    greeting = f"Hoi {p.contact_name}," if not _is_blank(p.contact_name) else "Hoi,"
+    notes_text = p.notes if not _is_blank(p.notes) else "mogelijkheden voor optimalisatie"
+    subject = subject_fmt.format(company=p.company)
+    body = body_fmt.format(company=p.company, greeting=greeting, notes_text=notes_text)
     return subject, body
 
 
-def gemini_generate(api_key: str, model: str, cfg: CampaignConfig, p: Prospect) -> tuple[str, str]:
+def simple_template(cfg: CampaignConfig, p: Prospect) -> tuple[str, str]:
+    return render_template(compile_template(cfg), p)
+
+
+# Configure the model
+_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,  # Fixed: was 64, max is 40 for Flash-8B
+    "max_output_tokens": 300,
+}
+
+_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+
+@functools.lru_cache(maxsize=4)
+def _gemini_model(api_key: str, model: str):
+    """Configured GenerativeModel, built once per (api_key, model) and reused so
+    SDK setup and the underlying connection are shared across calls."""
     if not genai:
         raise RuntimeError("google-generativeai package not available")
     
     genai.configure(api_key=api_key)
     
-    # Configure the model
-    generation_config = {
-        "temperature": 0.7,
-        "top_p": 0.95,
-        "top_k": 40,  # Fixed: was 64, max is 40 for Flash-8B
-        "max_output_tokens": 300,
-    }
-    
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-    ]
-    
-    model_instance = genai.GenerativeModel(
+    return genai.GenerativeModel(
         model_name=model,
-        generation_config=generation_config,
-        safety_settings=safety_settings,
+        generation_config=_GENERATION_CONFIG,
+        safety_settings=_SAFETY_SETTINGS,
     )
-    
+
+
+def _gemini_prompt(cfg: CampaignConfig, p: Prospect) -> str:
     system_prompt = (
         "Je bent een NL sales copywriter. Schrijf 1 korte, beleefde cold email (<= 120 woorden), "
         "met duidelijke waardepropositie en 1 concrete vraag. Gebruik eenvoudige taal en geen buzzwords. "
@@ -81,46 +128,68 @@ def gemini_generate(api_key: str, model: str, cfg: CampaignConfig, p: Prospect)
         f"Prospect: company='{p.company}', contact='{p.contact_name}', notes='{p.notes}'.\n"
     )
     
-    full_prompt = f"{system_prompt}\n\n{user_prompt}"
+    return f"{system_prompt}\n\n{user_prompt}"
+
+
+def _parse_gemini_response(text: Optional[str], cfg: CampaignConfig, p: Prospect) -> tuple[str, str]:
+    content = text or "{}"
+    
+    # Take the outermost {...}; this also drops ```json fences and any surrounding text
+    match = _JSON_EXTRACT_RE.search(content)
+    if match:
+        content = match.group(0)
     
     try:
-        response = model_instance.generate_content(full_prompt)
-        content = response.text or "{}"
-        
-        # Clean up markdown code blocks if present
-        content = content.strip()
-        if content.startswith("```json"):
-            content = content[7:]  # Remove ```json
-        if content.startswith("```"):
-            content = content[3:]   # Remove ```
-        if content.endswith("```"):
-            content = content[:-3]  # Remove ```
-        content = content.strip()
+        data = json.loads(content)
+        # Handle if it's an array instead of object (take first)
+        if isinstance(data, list) and len(data) > 0:
+            data = data[0]
         
-        # Remove any text before first { or after last }
-        start_idx = content.find('{')
-        end_idx = content.rfind('}')
-        if start_idx >= 0 and end_idx >= 0:
-            content = content[start_idx:end_idx+1]
+        subject = data.get("subject") or f"{p.company} x {cfg.service_name}?"
+        body = data.get("body") or ""
         
-        import json
-        try:
-            data = json.loads(content)
-            # Handle if it's an array instead of object (take first)
-            if isinstance(data, list) and len(data) > 0:
-                data = data[0]
-            
-            subject = data.get("subject") or f"{p.company} x {cfg.service_name}?"
-            body = data.get("body") or ""
-            
-            print(f"DEBUG: Successfully parsed Gemini response")
-            return subject, body
-        except Exception as e:
-            print(f"DEBUG: JSON parsing failed: {e}")
-            print(f"DEBUG: Cleaned content: {content}")
-            # Fallback to template if parsing failed
-            return simple_template(cfg, p)
+        logger.debug("Successfully parsed Gemini response")
+        return subject, body
     except Exception as e:
-        print(f"DEBUG: Gemini API call failed: {e}")
+        logger.warning("Gemini JSON parsing failed, using template: %s", e)
+        logger.debug("Cleaned content: %s", content)
+        # Fallback to template if parsing failed
+        return simple_template(cfg, p)
+
+
+def gemini_generate(api_key: str, model: str, cfg: CampaignConfig, p: Prospect) -> tuple[str, str]:
+    model_instance = _gemini_model(api_key, model)
+    try:
+        response = model_instance.generate_content(_gemini_prompt(cfg, p))
+        return _parse_gemini_response(response.text, cfg, p)
+    except Exception as e:
+        logger.warning("Gemini API call failed, using template: %s", e)
         # Fallback to template if API call failed
         return simple_template(cfg, p)
+
+
+def gemini_generate_batch(
+    api_key: str, model: str, cfg: CampaignConfig, prospects: List[Prospect], concurrency: int = 10
+) -> List[tuple[str, str]]:
+    """Generate emails for many prospects concurrently, in prospect order.
+
+    The calls are network-bound, so they are overlapped with asyncio; the
+    semaphore caps in-flight requests to stay within the API rate limit.
+    """
+    model_instance = _gemini_model(api_key, model)
+
+    async def _one(semaphore: asyncio.Semaphore, p: Prospect) -> tuple[str, str]:
+        async with semaphore:
+            try:
+                response = await model_instance.generate_content_async(_gemini_prompt(cfg, p))
+                return _parse_gemini_response(response.text, cfg, p)
+            except Exception as e:
+                logger.warning("Gemini API call failed, using template: %s", e)
+                # Fallback to template if API call failed
+                return simple_template(cfg, p)
+
+    async def _all() -> List[tuple[str, str]]:
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        return await asyncio.gather(*(_one(semaphore, p) for p in prospects))
+
+    return asyncio.run(_all())